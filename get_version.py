@@ -65,8 +65,16 @@ def get_version_info(marksdata_dir: str = None) -> dict:
         # Count lines (exact CPU count if no duplicates were detected when file was created, broad approximation
         # otherwise)
         try:
-            with open(csv_file, 'r', encoding='utf-8') as f:
-                line_count = sum(1 for _ in f) - 1  # -1 for header
+            # Count newline bytes by chunks: no decoding, no per-line object
+            line_count = 0
+            last = b'\n'
+            with open(csv_file, 'rb', buffering=0) as f:
+                while chunk := f.read(1 << 20):
+                    line_count += chunk.count(b'\n')
+                    last = chunk[-1:]
+            if last != b'\n':  # last line is not terminated
+                line_count += 1
+            line_count -= 1  # -1 for header
             result["total_cpus"] = str(line_count)
         except Exception:
             pass
@@ -2,13 +2,13 @@
 import re
 import sys
 import os
-import argparse
 import logging
 import csv
 import json
 import enum
 import math
-from collections import defaultdict
+import functools
+from collections import defaultdict, Counter
 
 # Add project root to Python path
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -34,6 +34,10 @@ _formatter = logging.Formatter('[%(levelname)-7s] %(filename)s(%(lineno)d): %(me
 _hdlr.setFormatter(_formatter)
 _logger.addHandler(_hdlr)
 
+# Translation table and pattern used on the hot path, built once
+_DELIM_TRANS = str.maketrans('-;,@', '    ')  # token delimiters, all mapped to ' '
+_MODEL_RE = re.compile(r'.*([A-Za-z]\d{1,4}).*')
+
 
 class CpuAssessor:
     """Main class"""
@@ -56,93 +60,129 @@ class CpuAssessor:
             return self.name
 
     __is_initialized = False
+    __loaded_from = ''
     __marks: dict = {}
     __names: dict = {}
-    __markswithsets: dict = {}
+    __posting: dict = {}
+    __keys: list = []
+    __lens: list = []
+    __toksnoat: list = []
     __marksnoat: dict = {}
 
     @staticmethod
     def init(marksfile: str):
-        """Wrapper to avoid multiple initializations"""
-        if CpuAssessor.__is_initialized:
+        """Wrapper to avoid multiple initializations from the same marks file"""
+        if CpuAssessor.__is_initialized and CpuAssessor.__loaded_from == marksfile:
             return
 
-        with open(marksfile, 'r') as csvfile_:
-            reader_ = csv.DictReader(csvfile_, delimiter=';')
-            line = 2
-            for r in reader_:
-                try:
-                    nam = r['name']
-                except KeyError:  # need to adapt to CSV files from different sources
-                    try:
-                        nam = r['NAME']
-                    except KeyError:
-                        try:
-                            nam = r['CPUNAME']
-                        except KeyError as exc:
-                            raise RuntimeError("Unable to guess which column has the name of the CPU") from exc
-                if 'Intel' in nam or 'AMD' in nam:
-                    try:
-                        m = r['cpumark']
-                    except KeyError:  # need to adapt to CSV files from different sources
-                        try:
-                            m = r['CPUMARK']
-                        except KeyError as exc:
-                            raise RuntimeError("Unable to guess which column has the mark of the CPU") from exc
-                    CpuAssessor.__marks[nam.lower()] = (int(m), line)
-                    CpuAssessor.__names[line] = nam
-                line += 1
-
-        CpuAssessor.__marksnoat = {k.split('@')[0].strip(): v for k, v in CpuAssessor.__marks.items() if '@' in k}
-        CpuAssessor.__markswithsets = {k: {"toks": CpuAssessor._keytoset(k), "mark": v}
-                                       for k, v in CpuAssessor.__marks.items()}
+        # first initialization, or switching to another marks file
+        CpuAssessor.__is_initialized = False
+        CpuAssessor.__marks = {}
+        CpuAssessor.__names = {}
+        with open(marksfile, 'rb') as csvfile_:
+            rawlines_ = csvfile_.read().splitlines()
+        header = next(csv.reader([rawlines_[0].decode('utf-8')], delimiter=';')) if rawlines_ else []
+        # need to adapt to CSV files from different sources
+        name_idx = next((header.index(h) for h in ('name', 'NAME', 'CPUNAME') if h in header), None)
+        if name_idx is None:
+            raise RuntimeError("Unable to guess which column has the name of the CPU")
+        mark_idx = next((header.index(h) for h in ('cpumark', 'CPUMARK') if h in header), None)
+        if mark_idx is None:
+            raise RuntimeError("Unable to guess which column has the mark of the CPU")
+        # Rows that do not mention Intel or AMD at all are dropped before being decoded and parsed
+        lines_, kept_ = [], []
+        line = 2
+        for raw in rawlines_[1:]:
+            if not raw:  # like csv.DictReader, skip blank lines without counting them
+                continue
+            if b'Intel' in raw or b'AMD' in raw:
+                lines_.append(line)
+                kept_.append(raw.decode('utf-8'))
+            line += 1
+        for line, r in zip(lines_, csv.reader(kept_, delimiter=';')):
+            nam = r[name_idx]
+            if 'Intel' in nam or 'AMD' in nam:
+                CpuAssessor.__marks[nam.lower()] = (int(r[mark_idx]), line)
+                CpuAssessor.__names[line] = nam
+
+        CpuAssessor.__marksnoat = {k.partition('@')[0].strip(): v for k, v in CpuAssessor.__marks.items() if '@' in k}
+        # Keys are encoded as their rank in the CSV file, and what the CLEVER steps need to know about them is kept in
+        # lists indexed by rank: __keys[rank] is the key, __lens[rank] its number of tokens, __toksnoat[rank] its tokens
+        # once the '@ x.yzGHz' part is removed
+        CpuAssessor.__keys = list(CpuAssessor.__marks)
+        CpuAssessor.__lens = []
+        CpuAssessor.__toksnoat = []
+        # Inverted index token -> ranks of the CSV keys, so that candidates are only searched among keys sharing a
+        # token with the query
+        posting = defaultdict(list)
+        for rank, k in enumerate(CpuAssessor.__keys):
+            toks = CpuAssessor._keytoset(k)
+            CpuAssessor.__lens.append(len(toks))
+            CpuAssessor.__toksnoat.append(CpuAssessor._keytoset(k.partition('@')[0].strip()) if '@' in k else toks)
+            for t in toks:
+                posting[t].append(rank)
+        CpuAssessor.__posting = {t: tuple(ranks) for t, ranks in posting.items()}
+        CpuAssessor._nmatch.cache_clear()  # results depend on the marks file
+        CpuAssessor.__loaded_from = marksfile
 
     def __init__(self, mf: str):
         CpuAssessor.init(mf)
         CpuAssessor.__is_initialized = True
 
     @classmethod
-    def _keytoset(cls, k: str):  # -> set[str]:
-        li = re.split(r'[ \-;,@]+', k)
+    def _keytoset(cls, k: str):  # -> frozenset[str]:
+        li = k.translate(_DELIM_TRANS).split(' ')  # empty tokens from runs of delimiters are skipped below
         # re.split(r'[ \-\;\,@]+', 'AMD PRO A10-8730B R5, 10 COMPUTE CORES 4C+6G @ 3.45GHz')
         # ['AMD', 'PRO', 'A10', '8730B', 'R5', '10', 'COMPUTE', 'CORES', '4C+6G', '3.45GHz']
         s = set()
         for t in li:
             if not t or 'Duo' in t:
                 continue
-            m = re.match(r'^(?P<D>\d+)(?P<L>\w+)$', t)
-            if re.match(r'^(?P<D>\d+)$', t) or not m:
+            if t.isdecimal():
                 s.add(t)
+                continue
+            # split '8730B' into '8730' and 'B' (and then into letters), provided the tail is made of word chars
+            i = 0
+            while i < len(t) and t[i].isdecimal():
+                i += 1
+            if i and t[i:].replace('_', 'x').isalnum():
+                s.add(t[:i])
+                s.update(t[i:])
             else:
-                # m.groupdict()  # Out[16]: {'D': '8730', 'L': 'B'}
-                s.add(m.groupdict()['D'])
-                s = s.union(set(m.groupdict()['L']))
-        return s
+                s.add(t)
+        return frozenset(s)
 
     @classmethod
-    def _nmatch(cls, x: str):  # -> tuple[int, tuple[MatchStep, int, str], list[str]]:
+    @functools.lru_cache(maxsize=4096)  # BIOS strings are very repetitive; results are immutable
+    def _nmatch(cls, x: str):  # -> tuple[int, tuple[MatchStep, int, str], tuple[str, ...]]:
         x = x.lower()
-        det = []
+        det = ()
         ret = cls.__marksnoat.get(x, (0, 0))
         if ret[0]:
             return ret[0], (cls.MatchStep.SIMPLE_0, ret[1], cls.__names[ret[1]]), det
-        cx = x.replace('(r)', '').replace('(tm)', '').replace(' cpu', '')
-        m = re.match(r'.*(?P<keep>(Intel|AMD).*)', cx, flags=re.I)  # remove everything before Intel|AMD
-        if m:
-            cx = m.groupdict()['keep']
-        cx = cx.split('w/')[0].strip()
-        cx = cx.split(',')[0]  # remove everything after and including a ','
-        ret = cls.__marks.get(cx, (0, 0))
-        if ret[0]:
-            return ret[0], (cls.MatchStep.SIMPLE_1, ret[1], cls.__names[ret[1]]), det
+        x_clean = x.replace('(r)', '').replace('(tm)', '').replace(' cpu', '')
+        cx = x_clean
+        i = max(cx.rfind('intel'), cx.rfind('amd'))  # remove everything before (the last) Intel|AMD
+        if i >= 0:
+            cx = cx[i:]
+        cx = cx.partition('w/')[0].strip()
+        cx = cx.partition(',')[0]  # remove everything after and including a ','
+        # all keys of cls.__marks contain 'intel' or 'amd': without them, cx cannot be found there
+        if i >= 0:
+            ret = cls.__marks.get(cx, (0, 0))
+            if ret[0]:
+                return ret[0], (cls.MatchStep.SIMPLE_1, ret[1], cls.__names[ret[1]]), det
         if cx.startswith('AMD') or cx.startswith('amd'):
-            cx = cx.split(' with')[0]  # remove everything after and including a "' with'"
-        ret = cls.__marks.get(cx, (0, 0))
-        if ret[0]:
-            return ret[0], (cls.MatchStep.SIMPLE_2, ret[1], cls.__names[ret[1]]), det
-        ret = cls.__marksnoat.get(cx, (0, 0))
-        if ret[0]:
-            return ret[0], (cls.MatchStep.SIMPLE_3, ret[1], cls.__names[ret[1]]), det
+            cx_with = cx
+            cx = cx.partition(' with')[0]  # remove everything after and including a "' with'"
+            if cx != cx_with:  # otherwise it was looked up by SIMPLE_1
+                ret = cls.__marks.get(cx, (0, 0))
+                if ret[0]:
+                    return ret[0], (cls.MatchStep.SIMPLE_2, ret[1], cls.__names[ret[1]]), det
+        if cx != x:  # otherwise it was looked up by SIMPLE_0
+            ret = cls.__marksnoat.get(cx, (0, 0))
+            if ret[0]:
+                return ret[0], (cls.MatchStep.SIMPLE_3, ret[1], cls.__names[ret[1]]), det
         # 'Intel Core i5-3380M' is found as 'Intel Core i5-3380M @ 2.90GHz' in cls.__marks
         # ==> we need to tamper with cls.__marks a bit...
         # Idea: try to turn entries with 'Intel...@ x.yzGHz' into two entries with same score while making sure the
@@ -150,44 +190,60 @@ class CpuAssessor:
         # ks= [_ for _ in cls.__marks if _.startswith('Intel') and re.match(r'^(?P<keep>(Intel).*) @ ?\d\.\d\d?GHz', _)]
         # ...add code here...
         # x = x.replace('(R)', '').replace('(TM)', '').replace(' CPU', '')
-        x = x.replace('(r)', '').replace('(tm)', '').replace(' cpu', '')
+        x = x_clean  # the CLEVER steps look at the whole string, not at what the SIMPLE steps kept of it
         mys = cls._keytoset(x)
-        candidates1 = [k for k, v in cls.__markswithsets.items() if v['toks'] <= mys]
+        # cnt[rank] == len(mys & toks of the key), only for keys sharing at least one token with mys
+        cnt = Counter()
+        for t in mys:
+            cnt.update(cls.__posting.get(t, ()))
+        # single pass over the keys sharing a token with mys to build the candidates of all CLEVER steps
+        threshold2 = 3 if 'amd' in x else 4
+        lens = cls.__lens
+        lmys = len(mys)
+        ranks1, ranks2, ranks3 = [], [], []
+        for r, c in cnt.items():
+            lk = lens[r]
+            if c == lk:  # toks of the key <= mys
+                ranks1.append(r)
+            if c >= threshold2:
+                ranks2.append(r)
+                if c == lmys and lk > c:  # toks of the key > mys
+                    ranks3.append(r)
+        # sorting the ranks keeps the order of the CSV file, as with a linear scan
+        for ranks in (ranks1, ranks2, ranks3):
+            ranks.sort()
+        candidates1, candidates2, candidates3 = ([cls.__keys[r] for r in ranks] for ranks in (ranks1, ranks2, ranks3))
         if len(candidates1) == 1:
             ret = cls.__marks.get(candidates1[0], (0, 0))
             return ret[0], (cls.MatchStep.CLEVER_1, ret[1], cls.__names[ret[1]]), det
-        threshold2 = 3 if 'amd' in x else 4
-        candidates2 = [k for k, v in cls.__markswithsets.items() if len(mys & v['toks']) >= threshold2]
         if len(candidates2) == 1:
             ret = cls.__marks.get(candidates2[0], (0, 0))
             return ret[0], (cls.MatchStep.CLEVER_2, ret[1], cls.__names[ret[1]]), det
-        candidates3 = [_ for _ in candidates2 if cls._keytoset(_) > mys]
         if len(candidates3) == 1:
             ret = cls.__marks.get(candidates3[0], (0, 0))
             return ret[0], (cls.MatchStep.CLEVER_3_1, ret[1], cls.__names[ret[1]]), det
-        for c in candidates3:
-            cs = cls._keytoset(c.split('@')[0].strip())
-            if cs == mys:
-                ret = cls.__marks.get(c, (0, 0))
+        for r in ranks3:
+            if cls.__toksnoat[r] == mys:
+                ret = cls.__marks.get(cls.__keys[r], (0, 0))
                 return ret[0], (cls.MatchStep.CLEVER_3_2, ret[1], cls.__names[ret[1]]), det
         # Very special cases:
         # ['Pentium T4500', 'Intel Core2 T7200', 'Pentium E5400', 'Intel Pentium Dual T3200']
         # m = re.match(r'.*(?P<model>[A-Z]\d{1,4}).*', x)
-        m = re.match(r'.*(?P<model>[A-Za-z]\d{1,4}).*', x)
+        m = _MODEL_RE.match(x)
         if m:
-            model = m.groupdict()['model']
-            candidates4 = [k for k, v in cls.__markswithsets.items() if model in v['toks']]
+            model = m.group(1)
+            candidates4 = [cls.__keys[r] for r in cls.__posting.get(model, ())]  # ranks are in CSV order
             if len(candidates4) == 1:
                 ret = cls.__marks.get(candidates4[0], (0, 0))
                 return ret[0], (cls.MatchStep.DESPERATE_1, ret[1], cls.__names[ret[1]]), det
         else:
             candidates4 = []
 
-        det += [f'"{x}" ==> {mys}', f'{candidates1}', f'{candidates2}', f'{candidates3}', f'{candidates4}']
+        det += (f'"{x}" ==> {set(mys)}', f'{candidates1}', f'{candidates2}', f'{candidates3}', f'{candidates4}')
         return 0, (cls.MatchStep.FAILED, 0, ''), det
 
     @classmethod
-    def assess(cls, cpu: str):  # -> tuple[int, tuple[MatchStep, int, str], list[str]]:
+    def assess(cls, cpu: str):  # -> tuple[int, tuple[MatchStep, int, str], tuple[str, ...]]:
         """Most important entry point!"""
         if not cls.__is_initialized:
             raise RuntimeError("Class CpuAssessor must be initialized before use")
@@ -208,7 +264,7 @@ class CpuAssessor:
         warned: int = 0
         for nam, ourmarks in ournames.items():
             ma, (meth, nline, line), det = cls._nmatch(nam)
-            if meth not in [cls.MatchStep.SIMPLE_0, cls.MatchStep.SIMPLE_1]:
+            if meth not in _TRIVIAL_STEPS:
                 _logger.debug(f'"{nam}" has a mark of {ma} ({meth}, {nline}, "{line}")')
             stats[meth.name] += 1
             if meth == cls.MatchStep.FAILED:
@@ -223,25 +279,25 @@ class CpuAssessor:
                 deltapcmin_ = abs((100.0 * (int(ma) - min_)) / min_)
                 deltapcmax_ = abs((100.0 * (int(ma) - max_)) / max_)
                 deltapcavg_ = abs((100.0 * (int(ma) - avg_)) / avg_)
-                sq_diffs_ = [(x - avg_) ** 2 for x in lmarks_]
-                variance_ = sum(sq_diffs_) / len(lmarks_)
-                sd_ = math.sqrt(variance_)
-                if deltapcavg_ <= threshold and not (deltapcmin_ <= threshold and deltapcmax_ <= threshold):
-                    weird += 1
                 if deltapcavg_ <= threshold:
+                    if not (deltapcmin_ <= threshold and deltapcmax_ <= threshold):
+                        weird += 1
                     ncorrect += 1
                 else:
-                    d_ = defaultdict(list)
-                    for o_ in ourmarks:
-                        d_[o_[0]].append(o_[1])
-                    d_ = dict(d_)
                     warned += 1
-                    _logger.warning(f'"{nam}" has a mark of {ma}'
-                                    f'\n  this is a {deltapcavg_:.2f}% gap v/s {avg_} average'
-                                    f' (sd = {sd_:.2f} [{100 * sd_ / avg_:.2f}%])'
-                                    f'\n  {deltapcmin_:.2f}%, {deltapcmax_:.2f}% gap v/s min = {min_}, max = {max_}'
-                                    f'\n  data set: {d_}')
                     nfalse += 1
+                    # the standard deviation and the data set are only needed for the message
+                    if _logger.isEnabledFor(logging.WARNING):
+                        variance_ = sum((x - avg_) ** 2 for x in lmarks_) / len(lmarks_)
+                        sd_ = math.sqrt(variance_)
+                        d_: dict = {}
+                        for m_, src_ in ourmarks:
+                            d_.setdefault(m_, []).append(src_)
+                        _logger.warning(f'"{nam}" has a mark of {ma}'
+                                        f'\n  this is a {deltapcavg_:.2f}% gap v/s {avg_} average'
+                                        f' (sd = {sd_:.2f} [{100 * sd_ / avg_:.2f}%])'
+                                        f'\n  {deltapcmin_:.2f}%, {deltapcmax_:.2f}% gap v/s min = {min_}, max = {max_}'
+                                        f'\n  data set: {d_}')
             else:
                 nmiss += 1
                 missed.append((nam, [(o[0], o[1]) for o in ourmarks]))
@@ -249,36 +305,53 @@ class CpuAssessor:
         return stats, missed, warned
 
 
-# ===== unused function =====
-# def get_mark_json(cpu_str: str, marksfile: str = _DEFAULTMARKSFILE) -> str:
-#     """Return CPU mark assessment as JSON string"""
-#     try:
-#         ca = CpuAssessor(marksfile)
-#         ma, (meth, nline, line), det = ca.assess(cpu_str)
-#
-#         result = {
-#             "error": False,
-#             "mark": str(ma),
-#             "cpustr": cpu_str,
-#             "hint": meth.name,
-#             "cpuscsv": os.path.basename(marksfile),
-#             "linenum": str(nline),
-#             "line": str(line),
-#             "details": det,
-#             "version": __version__
-#         }
-#     except Exception as e:
-#         result = {
-#             "error": True,
-#             "message": str(e),
-#             "version": __version__
-#         }
-#
-#     return json.dumps(result)
+# Steps not worth a debug message in CpuAssessor.test()
+_TRIVIAL_STEPS = frozenset({CpuAssessor.MatchStep.SIMPLE_0, CpuAssessor.MatchStep.SIMPLE_1})
+
+
+def get_mark_json(cpu_str: str, marksfile: str = _DEFAULTMARKSFILE) -> str:
+    """Return CPU mark assessment as JSON string"""
+    try:
+        # the resolved path lets CpuAssessor tell a genuine switch of marks file from another spelling of the same
+        return _json_assessment(cpu_str, os.path.realpath(marksfile), zero_is_error=False)
+    except Exception as e:
+        result = {
+            "error": True,
+            "message": str(e),
+            "version": __version__
+        }
+
+    return json.dumps(result)
+
+
+def _json_assessment(cpu: str, mfile: str, zero_is_error: bool = True) -> str:
+    """JSON output of the command line (--json); with zero_is_error, a null mark is flagged as an error"""
+    ma, (meth, nline, line), det = CpuAssessor(mfile).assess(cpu)
+    result = {
+        "error": zero_is_error and ma == 0,
+        "mark": str(ma),
+        "cpustr": cpu,
+        "hint": meth.name,
+        "cpuscsv": os.path.basename(mfile),
+        "linenum": str(nline),
+        "line": str(line),
+        "details": det,
+        "version": __version__
+    }
+    return json.dumps(result)
 
 
 if __name__ == "__main__":
 
+    # Fast path for drivers calling the script once per CPU with '--json --cpudesc CPU': no argparse at all
+    if len(sys.argv) == 4 and sys.argv[1] == '--json' and sys.argv[2] in ('-c', '--cpudesc'):
+        mfile_ = os.path.realpath(_DEFAULTMARKSFILE)
+        if os.path.isfile(mfile_) and os.access(mfile_, os.R_OK):  # otherwise let the full path report the error
+            print(_json_assessment(sys.argv[3], mfile_))
+            sys.exit(0)
+
+    import argparse
+
     class MyFormatter(argparse.MetavarTypeHelpFormatter, argparse.RawTextHelpFormatter):
         """Special formatter of mine"""
         # argparse.ArgumentDefaultsHelpFormatter,
@@ -399,22 +472,10 @@ if __name__ == "__main__":
 
     if not args_.test:
         # cpu_ = "Intel(R) Core(TM) i7-9700K CPU @ 3.60GHz"
-        ma_, (meth_, nline_, line_), det_ = ca_.assess(cpu_)
-
         if args_.json:
-            result_ = {
-                "error": True if ma_ == 0 else False,
-                "mark": str(ma_),
-                "cpustr": cpu_,
-                "hint": meth_.name,
-                "cpuscsv": os.path.basename(mfile_),
-                "linenum": str(nline_),
-                "line": str(line_),
-                "details": det_,
-                "version": __version__
-            }
-            print(json.dumps(result_))
+            print(_json_assessment(cpu_, mfile_))
         else:
+            ma_, (meth_, nline_, line_), det_ = ca_.assess(cpu_)
             print(f'"{cpu_}" a pour indice: {ma_} ({meth_}, {nline_}, "{line_}")')
     else:
         lmfile_ = os.path.realpath(args_.notes_historiques)
@@ -1,6 +1,7 @@
 """Code for maintaining the (important) CSV file in which CPU marks are searched"""
 import os
 import sys
+import io
 import csv
 import time
 import datetime
@@ -9,17 +10,55 @@ import enum
 import logging
 import json
 import re
+import itertools
+import hashlib
+import operator
+import threading
+from collections import Counter
 from http import HTTPStatus
-from typing import Any, Union  # , Optional
+from typing import Any, List, Union, Optional
 
 import urllib3
 import requests
+from requests.adapters import HTTPAdapter
 
-_datestamp = time.strftime("%Y%m%d.%H%M%S", datetime.datetime.now().timetuple())
+try:
+    import orjson  # optional, much faster decoding of the (big) JSON payload
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec  # optional, decodes the CPU records straight into light objects, skipping the unused keys
+except ImportError:
+    msgspec = None
+
+_datestamp = datetime.datetime.now().strftime("%Y%m%d.%H%M%S")
 _onLinux = sys.platform.startswith('linux')
 
 _THEPAGE = 'https://www.cpubenchmark.net/CPU_mega_page.html'
 
+# Leading tag of a CPU name, e.g. '[Dual CPU] '
+_BRACKET_RE = re.compile(r'^\[[^\[]+\]\s*')
+
+# Tag added to the name of a multi-CPU system, by number of CPUs
+_MULTI_PREFIX = {
+    2: '[Dual CPU] ',
+    3: '[3-Way CPU] ',
+    4: '[Quad CPU] ',
+    5: '[5-Way CPU] ',
+    8: '[8-Way CPU] ',
+    12: '[12-Way CPU] ',
+    16: '[16-Way CPU] ',
+}
+
+# The current CSV file (a symbolic link maintained by update_the_db.py) by default, i.e. when CpuMarks is not
+# told where it is, and the ETag of the last fetched data (with a fingerprint telling whether that file holds them)
+_LAST_CSV = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cpumarks.csv')
+_ETAG_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'cpumarks', 'etag')
+
+# Delay (in seconds) between the page and the data requests, to look more human if ever needed
+_AJAX_DELAY = 0.0
+
 # Setting test mode
 _IMAX = 0  # value for production version
 # _IMAX = 30  # for testing
@@ -32,16 +71,74 @@ _hdlr.setFormatter(_formatter)
 _logger.addHandler(_hdlr)
 
 
+def _json_loads(b: Union[bytes, bytearray]) -> Any:
+    """Decodes a JSON document given as bytes, with orjson when available"""
+    # orjson.JSONDecodeError is a subclass of json.JSONDecodeError, so callers only need to catch the latter
+    if orjson is not None:
+        return orjson.loads(b)
+    return json.loads(b)
+
+
+if msgspec is not None:
+    class _CpuRecord(msgspec.Struct, gc=False):
+        """The keys of a CPU record that are used; a missing one is decoded as '', like dict.get(k, '')"""
+        name: Any = ''
+        cores: Any = ''
+        cpuCount: Any = ''
+        secondaryCores: Any = ''
+        cpumark: Any = ''
+        thread: Any = ''
+        tdp: Any = ''
+        socket: Any = ''
+        cat: Any = ''
+
+
+    class _CpuData(msgspec.Struct, gc=False):
+        """The AJAX response, i.e. the CPU records in its 'data' key"""
+        data: List[_CpuRecord]
+
+
+    _RECORDS_DECODER = msgspec.json.Decoder(List[_CpuRecord])
+    _DATA_DECODER = msgspec.json.Decoder(_CpuData)
+
+
+def _decode_cpu_records(b: Union[bytes, bytearray], in_data: bool = False) -> list:
+    """Decodes the CPU records of a JSON document given as bytes: a list, or an object holding it in 'data'
+
+    With msgspec, the records are _CpuRecord objects; otherwise they are dicts"""
+    if msgspec is None:
+        d = _json_loads(b)
+        return d['data'] if in_data else d
+    try:
+        return _DATA_DECODER.decode(b).data if in_data else _RECORDS_DECODER.decode(b)
+    except msgspec.DecodeError as exc:  # also raised for a schema mismatch, e.g. no 'data' key
+        raise json.JSONDecodeError(str(exc), '', 0) from exc
+
+
 def _to_intstr_when_possible(s: Any) -> Union[str, Any]:
     if not isinstance(s, str):
         return s
+    t = s.replace(',', '')
+    # Fast path for the (many) values int() would reject anyway: it needs a sign or a digit after the spaces
+    lt = t.lstrip()
+    if not lt or not (lt[0].isdigit() or lt[0] in '+-'):
+        return s
     try:
-        i = int(s.replace(',', ''))
+        i = int(t)
     except ValueError:
         return s
     return str(i)
 
 
+def _columns_digest(cols: dict) -> str:
+    """Fingerprint of a dict of columns, the same once they are written into and read back from a CSV file"""
+    h = hashlib.sha256()
+    for k, col in cols.items():
+        h.update('\0'.join([k] + col).encode('utf-8', errors='surrogatepass'))
+        h.update(b'\1')
+    return h.hexdigest()
+
+
 @enum.unique
 class Source(enum.Enum):
     """Encodes where we are reading the data from: the web or an HTML file"""
@@ -58,37 +155,55 @@ class Technique(enum.Enum):
 
 class CpuMarks:
     """Main class"""
-    _d: list = []  # [dict[str, str]] = []
-    _keys_to_keep = {
-        'CPU Mark': 'cpumark',
-        'CPU Name': 'name',
-        'Category': 'cat',
-        'Cores': 'cores',
-        'Socket': 'socket',
-        'TDP (W)': 'tdp',
-        'Thread Mark': 'thread',
-    }
-    _ordered_fields = ['name', 'cores', 'cpumark', 'thread', 'tdp', 'socket', 'cat']
+    _d: list = []  # [dict[str, str]] = [], row view built lazily from _cols
+    _cols: dict = {}  # [str, list[str]] = {}, one list per field of the CSV file
+    _ordered_fields = ['name', 'cores', 'cpumark', 'thread', 'tdp', 'socket', 'cat']  # also the kept JSON keys
+    _interned_fields = ('socket', 'cat')  # a few dozen distinct values shared by thousands of rows
+    _session: Optional[requests.Session] = None
+    _lock = threading.Lock()  # serializes the (re)loads of the data
+    _last_csv = _LAST_CSV  # made from the last fetched data, reloaded when they did not change since
 
     @classmethod
     def _init(cls, tech: Technique) -> None:
         cls._get_the_data_from_web(tech=tech)
 
-    def __init__(self, tech: Technique = Technique.SCRAP) -> None:
-        if not CpuMarks._d:
-            CpuMarks._d = []
-            self._init(tech)
+    def __init__(self, tech: Technique = Technique.SCRAP, refresh: bool = False, last_csv: str = None) -> None:
+        """Loads the data once per process; refresh forces them to be fetched again
+
+        last_csv is the current CSV file (cpumarks.csv in the directory of this script by default)"""
+        with CpuMarks._lock:
+            if last_csv:
+                CpuMarks._last_csv = last_csv
+            if refresh or not CpuMarks.get_number_of_cpus():
+                CpuMarks._d = []
+                CpuMarks._cols = {}
+                self._init(tech)
+
+    @classmethod
+    def clear(cls) -> None:
+        """Forgets the loaded data, so that the next instantiation fetches them again"""
+        with cls._lock:
+            cls._d = []
+            cls._cols = {}
 
     @classmethod
     def get_number_of_cpus(cls) -> int:
         """Returns the number of know CPUs at the time"""
-        return len(cls._d)
+        return len(cls._cols.get('name', ()))
 
     @classmethod
     def get_cpu_list(cls):  # -> list[dict[str, str]]:
         """Returns all the data in a single JSON-style list"""
+        if not cls._d and cls._cols:
+            keys = list(cls._cols)
+            cls._d = [dict(zip(keys, row)) for row in zip(*cls._cols.values())]
         return cls._d
 
+    @classmethod
+    def get_columns(cls):  # -> dict[str, list[str]]:
+        """Returns all the data as one list of values per field, in the order of get_field_list()"""
+        return cls._cols
+
     @classmethod
     def get_field_list(cls):  # -> list[str]:
         """Returns the ordered field list for the resulting CSV file"""
@@ -109,8 +224,8 @@ class CpuMarks:
         _logger.info(f"Loading data from JSON file: {json_file}")
 
         try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                d = json.load(f)
+            with open(json_file, 'rb') as f:
+                d = _decode_cpu_records(f.read())
 
             if not d:
                 _logger.error("No data found in JSON file")
@@ -138,6 +253,16 @@ class CpuMarks:
         # Priority 2: Original direct method (fallback for non-restricted environments)
         cls._get_the_data_direct()
 
+    @classmethod
+    def _get_session(cls) -> requests.Session:
+        """Returns the HTTP session shared by all fetches, so that connections are kept alive and reused"""
+        if cls._session is None:
+            cls._session = requests.Session()
+            # Set session-wide SSL verification
+            cls._session.verify = False
+            cls._session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        return cls._session
+
     @classmethod
     def _get_the_data_direct(cls) -> None:
         """Collects the primary data from the web by accessing one magic page"""
@@ -164,16 +289,18 @@ class CpuMarks:
         try:
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-            session = requests.Session()
-            # Set session-wide SSL verification
-            session.verify = False
+            session = cls._get_session()
 
+            # Only the cookies are needed: the headers are processed as soon as they arrive, and the
+            # (big) body is never downloaded since the response is closed right after
             response = session.get(
                 _THEPAGE,
                 headers=initial_headers,
                 timeout=15,
-                allow_redirects=True
+                allow_redirects=True,
+                stream=True
             )
+            response.close()
 
             if response.status_code != 200:
                 _logger.error(f"Initial request failed with status {response.status_code}")
@@ -219,25 +346,49 @@ class CpuMarks:
             'Sec-Fetch-Site': 'same-origin',
         }
 
+        # Unless the data changed since the last fetch, the server then answers 304 with no body, and the data
+        # of the current CSV file (checked to be the ones of this ETag) are reused
+        etag, last_cols = cls._get_cached_etag()
+        if etag:
+            ajax_headers['If-None-Match'] = etag
+
         ts = int(time.time() * 1000)
         url = f"https://www.cpubenchmark.net/data/?_={ts}"
 
         _logger.info(f"Fetching data from {url}")
 
         try:
-            # Wait a bit to simulate human behavior
-            time.sleep(0.5)
+            if _AJAX_DELAY:
+                # Wait a bit to simulate human behavior
+                time.sleep(_AJAX_DELAY)
 
-            r = session.get(url, headers=ajax_headers, timeout=30)
+            # The body is streamed into a single buffer that is handed as is to the JSON decoder
+            r = session.get(url, headers=ajax_headers, timeout=30, stream=True)
             s = HTTPStatus(r.status_code)
 
+            if s == HTTPStatus.NOT_MODIFIED:
+                r.close()
+                if last_cols:
+                    _logger.info(f"Data not modified since the last fetch, reusing them from {cls._last_csv}")
+                    cls._d = []
+                    cls._cols = last_cols
+                    return
+                _logger.warning("Got 304 with nothing to reuse; fetching the data again, unconditionally")
+                ajax_headers.pop('If-None-Match', None)
+                r = session.get(url, headers=ajax_headers, timeout=30, stream=True)
+                s = HTTPStatus(r.status_code)
+
             if s != HTTPStatus.OK:
                 _logger.fatal(f'Request for the marks failed with status "{s.value}: {s.description}"')
                 _logger.debug(f"Response text: {r.text[:500]}")
                 return
 
-            d = json.loads(r.content.decode())['data']
+            buf = bytearray()
+            for chunk in r.iter_content(64 * 1024):
+                buf.extend(chunk)
+            d = _decode_cpu_records(buf, in_data=True)
             cls._process_cpu_data(d)
+            cls._save_etag(r.headers.get('ETag'), cls._cols)
 
         except requests.exceptions.Timeout:
             _logger.error("Request for data timed out")
@@ -248,80 +399,163 @@ class CpuMarks:
         except (json.JSONDecodeError, KeyError) as exc:
             _logger.error(f"Failed to parse JSON response: {exc}")
             # noinspection PyUnboundLocalVariable
-            _logger.debug(f"Response text: {r.text[:500]}")
+            _logger.debug(f"Response text: {buf[:500].decode(errors='replace')}")
             return
 
+    @classmethod
+    def _get_cached_etag(cls):  # -> tuple[str, Optional[dict]]:
+        """Returns the ETag of the last fetched data with the columns of the current CSV file, or ('', None) if
+        this file was not made from these data (e.g. made from a pre-fetched JSON file or replaced by hand)"""
+        try:
+            with open(_ETAG_FILE, encoding='utf-8') as f:
+                etag, _, digest = f.read().strip().partition('\n')
+        except OSError:
+            return '', None
+        if not etag or not digest:
+            return '', None
+        cols = cls._read_last_csv()
+        if cols is None or _columns_digest(cols) != digest:
+            _logger.info(f"{cls._last_csv} does not hold the data of the last fetch, ignoring its ETag")
+            return '', None
+        for k in cls._interned_fields:
+            if k in cols:
+                cols[k] = list(map(sys.intern, cols[k]))
+        return etag, cols
+
+    @classmethod
+    def _save_etag(cls, etag: Optional[str], cols: dict) -> None:
+        """Remembers the ETag of the data just fetched, with the fingerprint of their columns, for the next fetch"""
+        try:
+            if not etag:
+                if os.path.isfile(_ETAG_FILE):
+                    os.remove(_ETAG_FILE)
+                return
+            os.makedirs(os.path.dirname(_ETAG_FILE), exist_ok=True)
+            with open(_ETAG_FILE, mode='w', encoding='utf-8') as f:
+                f.write(f'{etag}\n{_columns_digest(cols)}\n')
+        except OSError as exc:
+            _logger.warning(f"Could not save the ETag in {_ETAG_FILE}: {exc}")
+
+    @classmethod
+    def _read_last_csv(cls) -> Optional[dict]:
+        """Reads the (already processed) data of the current CSV file as columns; None if there is no record"""
+        try:
+            with open(cls._last_csv, newline='', encoding='utf-8') as f:
+                reader = csv.reader(f, delimiter=';')
+                header = next(reader, [])  # an empty file has no record either
+                cols = {k: [] for k in header}
+                cols.update((k, list(col)) for k, col in zip(header, zip(*reader)))
+        except (OSError, csv.Error) as exc:
+            _logger.info(f"Could not read the data from {cls._last_csv}: {exc}")
+            return None
+        if not cols.get('name'):
+            _logger.info(f"No CPU record in {cls._last_csv}")
+            return None
+        return cols
+
     @classmethod
     def _process_cpu_data(cls, d: list) -> None:
         """Process the raw CPU data from the API"""
-        cls._d = []
-        for el in d:
+        if d and isinstance(d[0], dict):
+            def get(k):
+                return operator.methodcaller('get', k, '')
+        else:
+            # _CpuRecord objects: their attributes are faster to get than dict items
+            get = operator.attrgetter
+
+        names = list(map(get('name'), d))
+        cores = list(map(get('cores'), d))
+        for i, (cpucount, secondary) in enumerate(zip(map(get('cpuCount'), d), map(get('secondaryCores'), d))):
             # In most cases, "cpuCount" is represented as 1: int in the JSON structure; however, when
             # there are more than 1 CPU, "cpuCount" is represented as a string, e.g., "2"
             # Since we don't keep track of cpuCount, we need to update the value of "cores"
             try:
-                cpucount = int(el['cpuCount'])  # == 1 most of the time
-                cores = int(el['cores'])
+                cpucount = int(cpucount)  # == 1 most of the time
+                ncores = int(cores[i])
                 if cpucount > 1:
-                    el['cores'] = str(cores * cpucount)
-                    if cpucount == 2:
-                        el['name'] = '[Dual CPU] ' + el['name']
-                    elif cpucount == 3:
-                        el['name'] = '[3-Way CPU] ' + el['name']
-                    elif cpucount == 4:
-                        el['name'] = '[Quad CPU] ' + el['name']
-                    elif cpucount == 5:
-                        el['name'] = '[5-Way CPU] ' + el['name']
-                    elif cpucount == 8:
-                        el['name'] = '[8-Way CPU] ' + el['name']
-                    elif cpucount == 12:
-                        el['name'] = '[12-Way CPU] ' + el['name']
-                    elif cpucount == 16:
-                        el['name'] = '[16-Way CPU] ' + el['name']
+                    cores[i] = str(ncores * cpucount)
+                    prefix = _MULTI_PREFIX.get(cpucount)
+                    if prefix:
+                        names[i] = prefix + names[i]
                 else:
-                    el['cores'] = str(cores + int(el['secondaryCores']))
+                    cores[i] = str(ncores + int(secondary))
             except Exception as exc:  # pylint: disable=W0718
-                _logger.warning(f'Exception {exc}) was raised while processing {el}')
-            # Filter out the unused keys; keep values as they are
-            toapp = {k: _to_intstr_when_possible(v).strip() for k, v in el.items() if k in cls._keys_to_keep.values()}
-            toapp['cannonname'] = re.sub(r'^\[[^\[]+]\s*', '', el['name']).strip()
-            if toapp['cannonname'] != el['name']:
-                pass
-            cls._d.append(toapp)
+                _logger.warning(f'Exception {exc}) was raised while processing {d[i]}')
 
-        # Vérification des doublons
-        lnames = [_['name'] for _ in cls._d]
-        if len(lnames) != len(set(lnames)):
-            duplicates = {x: lnames.count(x) for x in lnames if lnames.count(x) > 1}
-            _logger.warning(f'Found {len(duplicates)} duplicate names')
-            for name in duplicates:
-                _logger.warning(f'{name}: {duplicates[name]} occurrences')
+        # Now that the values are fixed, each kept field is extracted as a whole column at once; the columns
+        # are built aside and published at the end, so that readers never see them half done
+        fixed = {'name': names, 'cores': cores}
+        cols = {k: [_to_intstr_when_possible(v).strip() for v in fixed.get(k) or map(get(k), d)]
+                for k in cls._ordered_fields}
+        sub = _BRACKET_RE.sub
+        cols['cannonname'] = [sub('', n).strip() for n in names]
+
+        for k in cls._interned_fields:
+            cols[k] = list(map(sys.intern, cols[k]))
 
+        cls._d = []
+        cls._cols = cols
 
-def write_csvfile(data: list, csvfile: str, fieldlist: list = None) -> None:
-    """Saves a list of records into a CSV file"""
+        # Vérification des doublons
+        counts = Counter(cols['name'])
+        duplicates = {n: c for n, c in counts.items() if c > 1}
+        if duplicates:
+            _logger.warning(f'Found {len(duplicates)} duplicate names')
+            for name, n in duplicates.items():
+                _logger.warning(f'{name}: {n} occurrences')
+
+
+def write_csvfile(data: Union[list, dict], csvfile: str, fieldlist: list = None) -> None:
+    """Saves a list of records, or a dict of columns as returned by CpuMarks.get_columns(), into a CSV file"""
+    is_cols = isinstance(data, dict)
+    nrows = len(next(iter(data.values()))) if is_cols and data else len(data)
+    if not nrows:
+        # e.g. the fetch failed: let the caller know, rather than writing (and maybe publishing) a header alone
+        raise ValueError('No CPU record to write')
+    keys = data.keys() if is_cols else data[0].keys()
     if fieldlist:
-        f = set(data[0].keys())
+        f = set(keys)
         if not set(fieldlist).issubset(f):
             _logger.error('Some fields are missing')
         fieldnames = fieldlist + sorted(list(f - set(fieldlist)))
     else:
-        fieldnames = sorted(data[0].keys())
-    with open(csvfile, mode='w', newline='\n', encoding='utf-8') as cfile:
-        writer = csv.DictWriter(cfile, fieldnames=fieldnames, delimiter=';', lineterminator='\n')
-        writer.writeheader()
-        i = 0
-        for row in data:
-            i += 1
-            if _IMAX and i > _IMAX:
-                break
-            try:
-                writer.writerow(row)
-            except UnicodeEncodeError as e:
-                print(f'Got UnicodeEncodeError at row {i} ({e})')
-                print(row)
-            else:
-                _logger.debug(row)
+        fieldnames = sorted(keys)
+
+    def rows():
+        """Yields the rows as positional sequences, a missing field being written empty"""
+        if is_cols:
+            return zip(*[data.get(k) or [''] * nrows for k in fieldnames])
+        return ([row.get(k, '') for k in fieldnames] for row in data)
+
+    # The whole file is built in memory and then written at once, instead of through many small writes
+    bio = io.BytesIO()
+    with io.TextIOWrapper(bio, encoding='utf-8', newline='\n', write_through=True) as cfile:
+        writer = csv.writer(cfile, delimiter=';', lineterminator='\n')
+        writer.writerow(fieldnames)
+        try:
+            writer.writerows(itertools.islice(rows(), _IMAX) if _IMAX else rows())
+        except UnicodeEncodeError:
+            # Start over row by row, to report the faulty rows while still writing the other ones
+            cfile.seek(0)
+            cfile.truncate()
+            writer.writerow(fieldnames)
+            i = 0
+            nwritten = 0
+            for row in rows():
+                i += 1
+                if _IMAX and i > _IMAX:
+                    break
+                try:
+                    writer.writerow(row)
+                except UnicodeEncodeError as e:
+                    print(f'Got UnicodeEncodeError at row {i} ({e})')
+                    print(dict(zip(fieldnames, row)))
+                else:
+                    nwritten += 1
+            _logger.debug(f'Wrote {nwritten} rows, the faulty ones being skipped')
+        content = bio.getvalue()
+    with open(csvfile, mode='wb') as ofile:
+        ofile.write(content)
 
 
 if __name__ == "__main__":
@@ -404,9 +638,9 @@ Le but de ce script est de récupérer les données d'évaluation des CPUs depui
 
     print(f'Found {cpumarks_.get_number_of_cpus()} CPUs')
 
-    d_ = cpumarks_.get_cpu_list()
+    cols_ = cpumarks_.get_columns()
 
     print(f'Writing CSV file {ofile_}')
-    write_csvfile(d_, ofile_, fieldlist=cpumarks_.get_field_list())
+    write_csvfile(cols_, ofile_, fieldlist=cpumarks_.get_field_list())
 
     sys.exit(0)
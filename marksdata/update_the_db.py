@@ -2,31 +2,40 @@
 import os
 import sys
 import json
-import time
 import datetime
+import argparse
+from typing import Optional
 from pathlib import Path as plPath
 
 from cpu_marks_db import CpuMarks, write_csvfile
 
 
-def update_now(current_marks: str):  # -> dict[str, str]:
-    """Creates a new marks DB and move the main symbolic link to point on it"""
+def update_now(current_marks: str, prefetch_json: Optional[str] = None):  # -> dict[str, str]:
+    """Creates a new marks DB and move the main symbolic link to point on it
+
+    When prefetch_json is given, the data are read from this already downloaded JSON file instead of the web"""
     # If current_marks is <PATH>/cpumarks-20251006.104052.csv,
     # we know that <PATH>/cpumarks.csv is a symbolic link like: cpumarks.csv -> cpumarks-20251006.104052.csv
     # We want to:
     #   -create <PATH>/cpumarks-{datestamp}}.csv
     #   -move cpumarks.csv to link to cpumarks-{datestamp}.csv
-    datestamp = time.strftime("%Y%m%d.%H%M%S", datetime.datetime.now().timetuple())
+    datestamp = datetime.datetime.now().strftime("%Y%m%d.%H%M%S")
     new_marks = ''
-    d = []
+    n = 0
+    previous_prefetch = os.environ.get('CPU_MARKS_PREFETCH_JSON')
     try:
-        marks = CpuMarks()
-        d = marks.get_cpu_list()
-        new_marks_name = f"cpumarks-{datestamp}.csv"
+        if prefetch_json:
+            # An explicit file must be used, not silently replaced by a fetch from the web
+            if not os.path.isfile(prefetch_json):
+                raise FileNotFoundError(f'Pre-fetched JSON file not found: {prefetch_json}')
+            os.environ['CPU_MARKS_PREFETCH_JSON'] = prefetch_json
         marks_dir = os.path.dirname(current_marks)
-        new_marks = os.sep.join([marks_dir, new_marks_name])
-        write_csvfile(d, new_marks, fieldlist=marks.get_field_list())
         link_full_name = plPath(os.sep.join([marks_dir, "cpumarks.csv"]))
+        marks = CpuMarks(refresh=True, last_csv=str(link_full_name))
+        n = marks.get_number_of_cpus()
+        new_marks_name = f"cpumarks-{datestamp}.csv"
+        new_marks = os.sep.join([marks_dir, new_marks_name])
+        write_csvfile(marks.get_columns(), new_marks, fieldlist=marks.get_field_list())
         if link_full_name.is_symlink() or link_full_name.exists():
             link_full_name.unlink()
         link_full_name.symlink_to(plPath(new_marks_name))
@@ -36,14 +45,35 @@ def update_now(current_marks: str):  # -> dict[str, str]:
     else:
         status = "success"
         reason = ''
+    finally:
+        if prefetch_json:
+            if previous_prefetch is None:
+                os.environ.pop('CPU_MARKS_PREFETCH_JSON', None)
+            else:
+                os.environ['CPU_MARKS_PREFETCH_JSON'] = previous_prefetch
 
     return {"status": status, "reason": reason,
-            "newmarksfile": f'{os.path.basename(new_marks)}', "newmarksnum": f'{len(d)}'}
+            "newmarksfile": f'{os.path.basename(new_marks)}', "newmarksnum": f'{n}'}
 
 
 if __name__ == "__main__":
+
+    class MyFormatter(argparse.MetavarTypeHelpFormatter, argparse.RawTextHelpFormatter):
+        """Special formatter of mine"""
+        pass
+
+
+    parser_ = argparse.ArgumentParser(description='Mettre à jour le fichier CSV des indices CPU',
+                                      add_help=False, formatter_class=MyFormatter)
+
+    parser_.add_argument('-h', '--help', action='help', help="Afficher ce message et quitter")
+
+    parser_.add_argument('--prefetch-json', type=str, required=False, metavar="JSONFILE",
+                         help="Fichier JSON déjà téléchargé à utiliser au lieu d'interroger le web")
+    args_ = parser_.parse_args()
+
     marksfile_ = os.path.realpath(os.sep.join([os.path.dirname(__file__), 'cpumarks.csv']))
     # print(marksfile_)
-    ret_ = update_now(marksfile_)
+    ret_ = update_now(marksfile_, prefetch_json=args_.prefetch_json)
     print(json.dumps(ret_))
     sys.exit(0)